@@ -3,18 +3,37 @@ Flask API + Scheduler: endpoints for recommendation, confirm, reminder setting,
 reminder-triggered slot view and background jobs.
 """
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from apscheduler.schedulers.background import BackgroundScheduler
-from recommender_service import recommend_top_k, log_recommendation_session, update_chosen_slot, get_training_data, train_ranking_model
-from config import REMINDER_CHECK_INTERVAL, MODEL_RETRAIN_INTERVAL, DB_URL, NOTIF_ENDPOINT
-from sqlalchemy import text, create_engine
+from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
+from recommender_service import recommend_top_k, log_recommendation_session, update_chosen_slot, invalidate_avail_slots
+from retrain import retrain_job
+from config import REMINDER_CHECK_INTERVAL, MODEL_RETRAIN_INTERVAL, NOTIF_ENDPOINT, RUN_SCHEDULER
+from db import engine, claim_job_run
+from sqlalchemy import text
 from datetime import datetime, timedelta
 import pandas as pd
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+
+# shared HTTP session: keep-alive + pooled connections for outbound calls
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (jsonify / request.json)."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-engine = create_engine(DB_URL, echo=False)
 app = Flask(__name__)
-sched = BackgroundScheduler()
-sched.start()
+app.json = ORJSONProvider(app)
+# retrain (CPU-bound sklearn fit) runs in its own process so it can't hold the GIL
+sched = BackgroundScheduler(executors={'default': ThreadPoolExecutor(4), 'processes': ProcessPoolExecutor(1)})
 
 # -------------------------
 # Recommend slots (UI path)
@@ -35,22 +54,29 @@ def recommend_slots():
 # -------------------------
 # Reminder-triggered slots (only last appointment time)
 # -------------------------
+def _last_booking_slot_row(conn, p, s):
+    """Return the most recent booking row for a primary-secondary pair (or None)."""
+    return conn.execute(text("""
+        SELECT start_time FROM bookings
+        WHERE primary_user_id=:p AND secondary_user_id=:s
+        ORDER BY start_time DESC LIMIT 1
+    """), {"p": p, "s": s}).mappings().fetchone()
+
+def _reminder_slot(start_time):
+    """Single-slot payload offered on the reminder page (last appointment time)."""
+    return {"slot_id": None, "slot_time": str(start_time), "score": 1.0}
+
 @app.route("/reminder_slots", methods=["POST"])
 def reminder_slots():
     data = request.json
     p = int(data['primary_user_id'])
     s = int(data['secondary_user_id'])
     with engine.connect() as conn:
-        last_b = conn.execute(text("""
-            SELECT start_time FROM bookings
-            WHERE primary_user_id=:p AND secondary_user_id=:s
-            ORDER BY start_time DESC LIMIT 1
-        """), {"p": p, "s": s}).fetchone()
+        last_b = _last_booking_slot_row(conn, p, s)
 
     if not last_b:
         return jsonify({"slots": [], "message": "No past booking found."})
-    slot = {"slot_id": None, "slot_time": str(last_b['start_time']), "score": 1.0}
-    return jsonify({"slots": [slot]})
+    return jsonify({"slots": [_reminder_slot(last_b['start_time'])]})
 
 # -------------------------
 # Set / update reminder (doctor)
@@ -82,20 +108,35 @@ def confirm_appointment():
     slot_id = data.get('slot_id')  # can be None for manual
     start = pd.to_datetime(data['slot_time'])
     end = start + pd.Timedelta(minutes=int(data.get('duration_minutes', 30)))
+    session_id = data.get('session_id')
+    params = {"p": p, "s": s, "start": start, "end": end}
+    booked = True
     with engine.begin() as conn:
-        conn.execute(text("""
-          INSERT INTO bookings (primary_user_id, secondary_user_id, start_time, end_time, status, created_at)
-          VALUES (:p,:s,:start,:end,'booked',NOW())
-        """), {"p": p, "s": s, "start": start, "end": end})
         if slot_id is not None:
-            conn.execute(text("UPDATE avail_slots SET is_booked=true WHERE id=:sid"), {"sid": int(slot_id)})
-    # update training log: mark chosen slot if session_id provided
-    session_id = data.get('session_id')
-    if session_id:
-        try:
-            update_chosen_slot(session_id, slot_id)
-        except Exception:
-            pass
+            # claim the slot and insert the booking in a single round-trip; the slot
+            # list may be cached (per worker), so only a still-free slot can be booked
+            params["sid"] = int(slot_id)
+            booked = conn.execute(text("""
+              WITH upd AS (
+                UPDATE avail_slots SET is_booked=true
+                WHERE id=:sid AND is_booked=false
+                RETURNING id
+              )
+              INSERT INTO bookings (primary_user_id, secondary_user_id, start_time, end_time, status, created_at)
+              SELECT :p,:s,:start,:end,'booked',NOW() FROM upd
+            """), params).rowcount > 0
+        else:
+            conn.execute(text("""
+              INSERT INTO bookings (primary_user_id, secondary_user_id, start_time, end_time, status, created_at)
+              VALUES (:p,:s,:start,:end,'booked',NOW())
+            """), params)
+        # update training log in the same transaction: mark chosen slot if session_id provided
+        if booked and session_id:
+            update_chosen_slot(session_id, slot_id, conn=conn)
+    if slot_id is not None:
+        invalidate_avail_slots(p)
+    if not booked:
+        return jsonify({"status": "conflict", "message": "Slot is no longer available."}), 409
     return jsonify({"status": "ok"})
 
 # -------------------------
@@ -108,75 +149,69 @@ def reminder_job():
       - get last booking for that primary-secondary pair
       - compute remind_time = last_booking + interval_days
       - if now >= remind_time and last_reminder_sent is None or older -> send reminder
-      - reminder payload uses reminder_slots API (only last appointment slot)
+      - reminder payload uses the reminder_slots slot (only last appointment slot)
+    Each interval is claimed in job_runs, so only one scheduler's tick does the work.
     """
-    sql = text("SELECT * FROM reminder_settings WHERE active=true")
+    if claim_job_run('reminder_job', REMINDER_CHECK_INTERVAL * 60):
+        _send_due_reminders()
+
+def _send_due_reminders():
+    # one round-trip: each active reminder joined with its pair's last booking
+    sql = text("""
+      SELECT r.*, b.start_time AS last_start
+      FROM reminder_settings r
+      LEFT JOIN LATERAL (
+        SELECT start_time FROM bookings
+        WHERE primary_user_id = r.primary_user_id AND secondary_user_id = r.secondary_user_id
+        ORDER BY start_time DESC LIMIT 1
+      ) b ON true
+      WHERE r.active = true
+    """)
     with engine.connect() as conn:
-        rows = conn.execute(sql).fetchall()
+        rows = conn.execute(sql).mappings().fetchall()
     now = datetime.utcnow()
+    sent_ids = []
     for row in rows:
         p, s = row['primary_user_id'], row['secondary_user_id']
         interval = row['reminder_interval_days']
         last_sent = row['last_reminder_sent']
-        with engine.connect() as conn:
-            last_b = conn.execute(text("""
-              SELECT start_time FROM bookings
-              WHERE primary_user_id=:p AND secondary_user_id=:s
-              ORDER BY start_time DESC LIMIT 1
-            """), {"p": p, "s": s}).fetchone()
-        if not last_b:
+        last_start = row['last_start']
+        if last_start is None:
             continue
-        remind_time = last_b['start_time'] + timedelta(days=interval)
-        # send if never sent before or now passed the remind_time
-        if last_sent is None or now >= remind_time:
-            # call local endpoint to get the single slot
-            try:
-                r = requests.post(f"http://127.0.0.1:8000/reminder_slots", json={"primary_user_id": p, "secondary_user_id": s}, timeout=5)
-                slots = r.json().get("slots", [])
-            except Exception:
-                slots = []
-            session_id = None
-            # log candidates into recommendation_logs for record-keeping (if any)
-            if slots:
-                # create a small candidate_df to log (one row)
-                try:
-                    import pandas as pd
-                    cand_df = pd.DataFrame([{
-                        'slot_id': None,
-                        'slot_time': pd.to_datetime(slots[0]['slot_time']) if slots[0]['slot_time'] != 'manual_input' else pd.Timestamp.now(),
-                        'same_hour': 1,
-                        'same_dow': 1,
-                        'hour_diff': 0.0,
-                        'slot_is_free': 1,
-                        'recent_count': 0
-                    }])
-                    session_id = log_recommendation_session(p, s, cand_df)
-                except Exception:
-                    session_id = None
-            payload = {"to_secondary_user_id": s, "primary_user_id": p, "message": "Your next appointment is due.", "recommended_slots": slots, "session_id": session_id}
+        remind_time = last_start + timedelta(days=interval)
+        # send once per cycle: due now and not already sent since remind_time
+        if now >= remind_time and (last_sent is None or last_sent < remind_time):
+            # single slot = last appointment time (same as /reminder_slots)
+            slots = [_reminder_slot(last_start)]
+            # the reminder slot has no avail_slots id, so it can't be logged as a
+            # training candidate (recommendation_logs.slot_id is NOT NULL): no session
+            payload = {"to_secondary_user_id": s, "primary_user_id": p, "message": "Your next appointment is due.", "recommended_slots": slots, "session_id": None}
             try:
-                requests.post(NOTIF_ENDPOINT, json=payload, timeout=5)
+                SESSION.post(NOTIF_ENDPOINT, json=payload, timeout=5)
             except Exception:
                 pass
-            # update last_reminder_sent
-            with engine.begin() as conn:
-                conn.execute(text("UPDATE reminder_settings SET last_reminder_sent = NOW() WHERE id=:id"), {"id": row['id']})
+            sent_ids.append(row['id'])
 
-# -------------------------
-# Retrain job
-# -------------------------
-def retrain_job():
-    try:
-        df = get_training_data(limit=5000)
-        if df is not None and not df.empty:
-            train_ranking_model(df)
-    except Exception:
-        pass
+    # update last_reminder_sent for every reminder handled this tick in one statement
+    if sent_ids:
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE reminder_settings SET last_reminder_sent = NOW() WHERE id = ANY(:ids)"), {"ids": sent_ids})
 
 # schedule background jobs
-sched.add_job(reminder_job, 'interval', minutes=REMINDER_CHECK_INTERVAL, id='reminder_job', replace_existing=True)
-sched.add_job(retrain_job, 'interval', days=MODEL_RETRAIN_INTERVAL, id='retrain_job', replace_existing=True)
+def start_scheduler():
+    """Start background jobs once per process (no-op if already running)."""
+    if sched.running:
+        return
+    sched.add_job(reminder_job, 'interval', minutes=REMINDER_CHECK_INTERVAL, id='reminder_job', replace_existing=True)
+    sched.add_job(retrain_job, 'interval', days=MODEL_RETRAIN_INTERVAL, id='retrain_job', replace_existing=True, executor='processes')
+    sched.start()
+
+# imported by a WSGI server: jobs only start where RUN_SCHEDULER=1 is set explicitly
+if RUN_SCHEDULER:
+    start_scheduler()
 
 if __name__ == "__main__":
+    # standalone dev server: single process, so it runs the background jobs itself
+    start_scheduler()
     app.run(host="0.0.0.0", port=8000)
 
@@ -13,4 +13,18 @@ NOTIF_ENDPOINT = os.getenv("NOTIF_ENDPOINT", "http://localhost:5001/notify")
 REMINDER_CHECK_INTERVAL = int(os.getenv("REMINDER_CHECK_INTERVAL_MINUTES", "10"))   # minutes
 MODEL_RETRAIN_INTERVAL = int(os.getenv("MODEL_RETRAIN_INTERVAL_DAYS", "7"))        # days
 
+# Start background jobs when api.py is imported (e.g. by gunicorn). Off by default so
+# multi-worker deployments don't run one scheduler per worker; `python api.py` always runs them.
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "0") == "1"
 
+# DB connection pool (shared by API handlers and background jobs)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))  # seconds
+
+# Available-slot cache (per primary user)
+SLOT_CACHE_TTL = int(os.getenv("SLOT_CACHE_TTL_SECONDS", "60"))  # seconds
+SLOT_CACHE_MAXSIZE = int(os.getenv("SLOT_CACHE_MAXSIZE", "2048"))
+
+# Training only uses logs older than this, so chosen=1 updates have landed first
+TRAINING_SETTLE_HOURS = int(os.getenv("TRAINING_SETTLE_HOURS", "24"))  # hours
@@ -0,0 +1,31 @@
+"""
+Shared DB engine: one connection pool for the API, background jobs and ML core.
+"""
+from sqlalchemy import create_engine, text
+from config import DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
+
+engine = create_engine(
+    DB_URL,
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    # psycopg2 fast execution helpers for executemany() batches
+    executemany_mode="values_plus_batch",
+)
+
+def claim_job_run(name, interval_seconds):
+    """
+    Atomically claim this interval's run of job `name` in job_runs.
+    Returns True for exactly one caller per interval, whichever worker's timer fires first;
+    later callers see a recent last_run and skip. 10% slack absorbs timer jitter.
+    """
+    sql = text("""
+      INSERT INTO job_runs (name, last_run) VALUES (:name, NOW())
+      ON CONFLICT (name) DO UPDATE SET last_run = NOW()
+      WHERE job_runs.last_run < NOW() - make_interval(secs => :gap)
+      RETURNING 1
+    """)
+    with engine.begin() as conn:
+        return conn.execute(sql, {"name": name, "gap": interval_seconds * 0.9}).first() is not None
@@ -3,17 +3,18 @@ ML core: feature extraction, candidate scoring (rules + ML), logging, training.
 """
 
 import os
+import time
 import uuid
 import pickle
+import threading
 from datetime import datetime
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, text
-from sklearn.linear_model import LogisticRegression
-from config import DB_URL, MODEL_PATH
-
-# DB engine
-engine = create_engine(DB_URL, echo=False)
+from sqlalchemy import text
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+from config import MODEL_PATH, SLOT_CACHE_TTL, SLOT_CACHE_MAXSIZE, TRAINING_SETTLE_HOURS
+from db import engine
 
 # -----------------------------
 # Data fetching helpers
@@ -28,15 +29,42 @@ def fetch_booking_history(primary_user_id, secondary_user_id, limit=200):
     """)
     return pd.read_sql(sql, engine, params={"p": primary_user_id, "s": secondary_user_id, "limit": limit})
 
-def fetch_future_avail_slots(primary_user_id, window_days=30):
+def _query_future_avail_slots(primary_user_id, window_days=30):
     sql = text("""
       SELECT id, slot_time, is_booked
       FROM avail_slots
       WHERE primary_user_id = :p
-        AND slot_time >= NOW()
-        AND slot_time <= NOW() + INTERVAL ':days days'
-    """.replace(':days', str(window_days)))
-    return pd.read_sql(sql, engine, params={"p": primary_user_id})
+        AND slot_time BETWEEN NOW() AND NOW() + make_interval(days => :days)
+        AND is_booked = false
+    """)
+    return pd.read_sql(sql, engine, params={"p": primary_user_id, "days": int(window_days)})
+
+# short-lived cache of future slots per (primary_user_id, window_days)
+_SLOT_CACHE = {}
+_SLOT_CACHE_LOCK = threading.Lock()
+
+def fetch_future_avail_slots(primary_user_id, window_days=30):
+    key = (primary_user_id, window_days)
+    now = time.monotonic()
+    with _SLOT_CACHE_LOCK:
+        hit = _SLOT_CACHE.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1].copy()
+    df = _query_future_avail_slots(primary_user_id, window_days=window_days)
+    with _SLOT_CACHE_LOCK:
+        if len(_SLOT_CACHE) >= SLOT_CACHE_MAXSIZE:
+            for k in [k for k, (exp, _) in _SLOT_CACHE.items() if exp <= now]:
+                del _SLOT_CACHE[k]
+            if len(_SLOT_CACHE) >= SLOT_CACHE_MAXSIZE:
+                _SLOT_CACHE.clear()
+        _SLOT_CACHE[key] = (now + SLOT_CACHE_TTL, df)
+    return df.copy()
+
+def invalidate_avail_slots(primary_user_id):
+    """Drop cached slot lists for a primary user (e.g. after a booking)."""
+    with _SLOT_CACHE_LOCK:
+        for k in [k for k in _SLOT_CACHE if k[0] == primary_user_id]:
+            del _SLOT_CACHE[k]
 
 # -----------------------------
 # Feature engineering
@@ -47,101 +75,202 @@ def build_candidate_features(primary_user_id, secondary_user_id, candidate_slots
     Returns a DataFrame with features for each candidate slot.
     """
     prev = history_df[history_df['status'] != 'cancelled']
-    prev_row = prev.iloc[0] if prev.shape[0] > 0 else None
-
-    features = []
-    for _, row in candidate_slots_df.iterrows():
-        slot_ts = pd.to_datetime(row['slot_time'])
-        slot_hour = slot_ts.hour
-        slot_dow = slot_ts.dayofweek  # Monday=0
-        slot_is_free = 0 if row.get('is_booked', False) else 1
-
-        # Defaults
-        same_hour = 0
-        same_dow = 0
-        hour_diff = 999.0
-        days_since_last = 999
-        recent_count = 0
-
-        if prev_row is not None:
-            prev_ts = pd.to_datetime(prev_row['start_time'])
-            same_hour = 1 if prev_ts.hour == slot_hour else 0
-            same_dow = 1 if prev_ts.dayofweek == slot_dow else 0
-            hour_diff = abs((slot_ts - prev_ts).total_seconds()) / 3600.0
-            days_since_last = (slot_ts.date() - prev_ts.date()).days
-            recent = prev.head(12)
-            recent_count = int((recent['start_time'].apply(lambda x: pd.to_datetime(x).hour) == slot_hour).sum())
-
-        features.append({
-            'slot_id': int(row['id']),
-            'slot_time': slot_ts,
-            'slot_hour': int(slot_hour),
-            'slot_dow': int(slot_dow),
-            'slot_is_free': int(slot_is_free),
-            'same_hour': int(same_hour),
-            'same_dow': int(same_dow),
-            'hour_diff': float(hour_diff),
-            'days_since_last': int(days_since_last),
-            'recent_count': int(recent_count)
-        })
-
-    return pd.DataFrame(features)
+    # parse history timestamps once; prev[0] is the most recent booking
+    prev_start = pd.to_datetime(prev['start_time'])
+
+    n = len(candidate_slots_df)
+    slot_ts = pd.to_datetime(candidate_slots_df['slot_time']).reset_index(drop=True)
+    hours = slot_ts.dt.hour.to_numpy()
+    dows = slot_ts.dt.dayofweek.to_numpy()  # Monday=0
+    if 'is_booked' in candidate_slots_df:
+        is_booked = candidate_slots_df['is_booked'].fillna(False).astype(bool).to_numpy()
+    else:
+        is_booked = np.zeros(n, dtype=bool)
+
+    # Defaults
+    same_hour = np.zeros(n, dtype=int)
+    same_dow = np.zeros(n, dtype=int)
+    hour_diff = np.full(n, 999.0)
+    days_since_last = np.full(n, 999, dtype=int)
+    recent_count = np.zeros(n, dtype=int)
+
+    if len(prev_start) > 0:
+        prev_ts = prev_start.iloc[0]
+        same_hour = (hours == prev_ts.hour).astype(int)
+        same_dow = (dows == prev_ts.dayofweek).astype(int)
+        hour_diff = np.abs((slot_ts - prev_ts).dt.total_seconds().to_numpy()) / 3600.0
+        days_since_last = (slot_ts.dt.normalize() - prev_ts.normalize()).dt.days.to_numpy()
+        recent_hours = prev_start.head(12).dt.hour.to_numpy()
+        recent_count = (recent_hours[:, None] == hours[None, :]).sum(axis=0)
+
+    return pd.DataFrame({
+        'slot_id': candidate_slots_df['id'].astype(int).to_numpy(),
+        'slot_time': slot_ts,
+        'slot_hour': hours.astype(int),
+        'slot_dow': dows.astype(int),
+        'slot_is_free': (~is_booked).astype(int),
+        'same_hour': same_hour.astype(int),
+        'same_dow': same_dow.astype(int),
+        'hour_diff': hour_diff.astype(float),
+        'days_since_last': days_since_last.astype(int),
+        'recent_count': recent_count.astype(int)
+    })
 
 # -----------------------------
 # Model utilities
 # -----------------------------
+# loaded model cached in-process; reloaded when the pickle's mtime changes
+_MODEL_CACHE = {"key": None, "model": None, "weights": None}
+
 def load_model(path=MODEL_PATH):
-    if os.path.exists(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    key = (path, mtime)
+    if _MODEL_CACHE["key"] != key:
         with open(path, 'rb') as f:
-            return pickle.load(f)
-    return None
+            model = pickle.load(f)
+        _MODEL_CACHE["model"] = model
+        _MODEL_CACHE["weights"] = _linear_weights(model)
+        _MODEL_CACHE["key"] = key
+    return _MODEL_CACHE["model"]
+
+def _linear_weights(model):
+    """
+    (coef, intercept) of a fitted linear classifier on raw features, or None if not linear.
+    A model-attached StandardScaler (`scaler_`) is folded into the weights.
+    """
+    try:
+        coef = np.array(model.coef_[0], dtype=float)
+        intercept = float(model.intercept_[0])
+    except (AttributeError, IndexError, TypeError):
+        return None
+    scaler = getattr(model, 'scaler_', None)
+    if scaler is not None:
+        coef = coef / scaler.scale_
+        intercept -= float(coef @ scaler.mean_)
+    return coef, intercept
+
+def _model_weights(model):
+    if model is _MODEL_CACHE["model"]:
+        return _MODEL_CACHE["weights"]
+    return _linear_weights(model)
 
-def train_ranking_model(training_df, save_path=MODEL_PATH):
+def _training_features(df):
+    return df[['slot_is_free','same_hour','same_dow','hour_diff','days_since_last','recent_count']].fillna(0).to_numpy(dtype=float)
+
+def train_ranking_model(training_data, save_path=MODEL_PATH, model=None, trained_through=None):
     """
-    Train a logistic regression ranking model on the training DataFrame.
-    training_df must contain columns: slot_is_free, same_hour, same_dow, hour_diff, days_since_last, recent_count, chosen
+    Train the logistic (log-loss SGD) ranking model.
+    training_data is a DataFrame or an iterable of DataFrame chunks with columns:
+    slot_is_free, same_hour, same_dow, hour_diff, days_since_last, recent_count, chosen
+    trained_through is the created_at cutoff the data was read up to; it is saved on the
+    model as the watermark for the next incremental run (None = next run refits fully).
+    Without `model`: full multi-epoch fit on standardized features; the fitted
+    StandardScaler is stored on the model as `scaler_`.
+    With `model`: partial_fit on the new rows only, through the model's frozen scaler;
+    returns None (and leaves the saved model untouched) if there are no new rows.
     """
-    if training_df.empty:
-        raise ValueError("Empty training data")
-    X = training_df[['slot_is_free','same_hour','same_dow','hour_diff','days_since_last','recent_count']].fillna(0)
-    y = training_df['chosen'].astype(int)
-    model = LogisticRegression(max_iter=500)
-    model.fit(X, y)
+    chunks = [training_data] if isinstance(training_data, pd.DataFrame) else training_data
+    if model is None:
+        frames = [chunk for chunk in chunks if not chunk.empty]
+        if not frames:
+            raise ValueError("Empty training data")
+        df = pd.concat(frames, ignore_index=True)
+        X = _training_features(df)
+        scaler = StandardScaler().fit(X)
+        model = SGDClassifier(loss='log_loss', max_iter=1000, tol=1e-4, random_state=0)
+        model.fit(scaler.transform(X), df['chosen'].astype(int))
+        model.scaler_ = scaler
+    else:
+        fitted = False
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            X = model.scaler_.transform(_training_features(chunk))
+            model.partial_fit(X, chunk['chosen'].astype(int), classes=[0, 1])
+            fitted = True
+        if not fitted:
+            return None
+    model.trained_through_ = trained_through
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    with open(save_path, 'wb') as f:
+    # write then rename so load_model never sees a half-written pickle
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
         pickle.dump(model, f)
+    os.replace(tmp_path, save_path)
     return model
 
 # -----------------------------
 # Scoring & recommend
 # -----------------------------
+def _usable_scores(rank_score, eps=1e-6):
+    """False when model rank scores can't order candidates: non-finite or all (near) equal."""
+    rank_score = np.asarray(rank_score, dtype=float)
+    if not np.all(np.isfinite(rank_score)):
+        return False
+    return not (len(rank_score) > 1 and np.ptp(rank_score) < eps)
+
 def score_candidates(candidate_df, model=None):
-    # Prepare features for ML
-    X = candidate_df[['slot_is_free','same_hour','same_dow','hour_diff','days_since_last','recent_count']].fillna(0)
-    ml_score = np.zeros(len(candidate_df))
+    ml_score = None
+    ml_rank = None
     if model is not None:
+        # Prepare features for ML
+        X = candidate_df[['slot_is_free','same_hour','same_dow','hour_diff','days_since_last','recent_count']].fillna(0)
+        # logistic model = dot product + sigmoid; skip sklearn's per-call validation
+        weights = _model_weights(model)
         try:
-            ml_score = model.predict_proba(X)[:,1]
+            if weights is not None:
+                coef, intercept = weights
+                # rank on the logit (same order as the sigmoid, never saturates);
+                # report the probability via a stable sigmoid
+                z = X.to_numpy(dtype=float) @ coef + intercept
+                ml_rank = z
+                ml_score = np.exp(-np.logaddexp(0.0, -z))
+            else:
+                ml_score = model.predict_proba(X)[:,1]
+                ml_rank = ml_score
         except Exception:
-            ml_score = np.zeros(len(candidate_df))
+            ml_score = None
+        if ml_score is not None and not _usable_scores(ml_rank):
+            ml_score = None
 
-    # Simple rule-based boost
-    rule_score = (
-        candidate_df['same_hour'] * 0.5 +
-        candidate_df['same_dow'] * 0.3 +
-        candidate_df['slot_is_free'] * 0.2 +
-        candidate_df['recent_count'] * 0.05
-    )
+    if ml_score is not None:
+        # the rule features are model inputs already: rank by the model alone
+        total_score = ml_score
+        rank_score = ml_rank
+    else:
+        # no (usable) model: simple rule-based score
+        rule_score = (
+            candidate_df['same_hour'] * 0.5 +
+            candidate_df['same_dow'] * 0.3 +
+            candidate_df['slot_is_free'] * 0.2 +
+            candidate_df['recent_count'] * 0.05
+        )
 
-    # hour diff penalty -> convert to decaying score
-    diff_score = np.exp(-candidate_df['hour_diff'] / 24.0)
+        # hour diff penalty -> convert to decaying score
+        diff_score = np.exp(-candidate_df['hour_diff'] / 24.0)
 
-    total_score = 0.6 * ml_score + 0.3 * rule_score + 0.1 * diff_score
-    candidate_df = candidate_df.copy()
+        total_score = 0.75 * rule_score + 0.25 * diff_score
+        rank_score = total_score
+
+    # score in place, unsorted: callers pick top-k with _top_k (partial selection)
     candidate_df['score'] = total_score
-    candidate_df = candidate_df.sort_values('score', ascending=False).reset_index(drop=True)
+    candidate_df['rank_score'] = rank_score
     return candidate_df
 
+def _top_k(scored_df, k):
+    """Top k rows by rank_score (descending) via partial selection instead of a full sort."""
+    n = len(scored_df)
+    if k <= 0:
+        return scored_df.iloc[:0]
+    if k >= n:
+        return scored_df.sort_values('rank_score', ascending=False)
+    scores = scored_df['rank_score'].to_numpy()
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return scored_df.iloc[idx].sort_values('rank_score', ascending=False)
+
 def recommend_top_k(primary_user_id, secondary_user_id, k=3, window_days=30, return_candidates=False):
     """
     Returns top-k recommended slots.
@@ -158,10 +287,12 @@ def recommend_top_k(primary_user_id, secondary_user_id, k=3, window_days=30, ret
     cand_feats = build_candidate_features(primary_user_id, secondary_user_id, slots, history)
     model = load_model()
     scored = score_candidates(cand_feats, model)
-    topk = scored.head(k)
+    topk = _top_k(scored, k)
     results = [
-        {"slot_id": int(r['slot_id']), "slot_time": r['slot_time'].isoformat(), "score": float(r['score'])}
-        for _, r in topk.iterrows()
+        {"slot_id": int(slot_id), "slot_time": pd.Timestamp(slot_time).isoformat(), "score": float(score)}
+        for slot_id, slot_time, score in zip(
+            topk['slot_id'].to_numpy(), topk['slot_time'].to_numpy(), topk['score'].to_numpy()
+        )
     ]
     if return_candidates:
         return results, scored
@@ -173,39 +304,55 @@ def recommend_top_k(primary_user_id, secondary_user_id, k=3, window_days=30, ret
 def log_recommendation_session(primary_user_id, secondary_user_id, candidate_df):
     """
     Logs candidate rows to recommendation_logs with chosen=0 default.
-    candidate_df expected to have columns: slot_id, slot_time, same_hour, same_dow, hour_diff, slot_is_free, recent_count
+    candidate_df expected to have columns: slot_id, slot_time, same_hour, same_dow, hour_diff, slot_is_free,
+    days_since_last, recent_count
     Returns session_id
     """
     session_id = str(uuid.uuid4())
     if candidate_df is None or candidate_df.empty:
         return session_id
 
+    sql = text("""
+      INSERT INTO recommendation_logs
+      (session_id, primary_user_id, secondary_user_id, slot_id, slot_time,
+       same_hour, same_dow, hour_diff, slot_is_free, days_since_last, recent_count, chosen)
+      VALUES (:sid,:p,:s,:slot_id,:slot_time,
+              :same_hour,:same_dow,:hour_diff,:slot_is_free,:days_since_last,:recent_count,0)
+    """)
+    # cast columns once, then send all rows as a single executemany batch
+    params = [
+        {
+            "sid": session_id,
+            "p": primary_user_id,
+            "s": secondary_user_id,
+            "slot_id": slot_id,
+            "slot_time": slot_time,
+            "same_hour": same_hour,
+            "same_dow": same_dow,
+            "hour_diff": hour_diff,
+            "slot_is_free": slot_is_free,
+            "days_since_last": days_since_last,
+            "recent_count": recent_count
+        }
+        for slot_id, slot_time, same_hour, same_dow, hour_diff, slot_is_free, days_since_last, recent_count in zip(
+            candidate_df['slot_id'].astype(int).tolist(),
+            pd.to_datetime(candidate_df['slot_time']).tolist(),
+            candidate_df['same_hour'].astype(int).tolist(),
+            candidate_df['same_dow'].astype(int).tolist(),
+            candidate_df['hour_diff'].astype(float).tolist(),
+            candidate_df['slot_is_free'].astype(int).tolist(),
+            candidate_df['days_since_last'].astype(int).tolist(),
+            candidate_df['recent_count'].astype(int).tolist()
+        )
+    ]
     with engine.begin() as conn:
-        for _, row in candidate_df.iterrows():
-            sql = text("""
-              INSERT INTO recommendation_logs
-              (session_id, primary_user_id, secondary_user_id, slot_id, slot_time,
-               same_hour, same_dow, hour_diff, slot_is_free, recent_count, chosen)
-              VALUES (:sid,:p,:s,:slot_id,:slot_time,
-                      :same_hour,:same_dow,:hour_diff,:slot_is_free,:recent_count,0)
-            """)
-            conn.execute(sql, {
-                "sid": session_id,
-                "p": primary_user_id,
-                "s": secondary_user_id,
-                "slot_id": int(row['slot_id']),
-                "slot_time": row['slot_time'].to_pydatetime(),
-                "same_hour": int(row['same_hour']),
-                "same_dow": int(row['same_dow']),
-                "hour_diff": float(row['hour_diff']),
-                "slot_is_free": int(row['slot_is_free']),
-                "recent_count": int(row['recent_count'])
-            })
+        conn.execute(sql, params)
     return session_id
 
-def update_chosen_slot(session_id, chosen_slot_id):
+def update_chosen_slot(session_id, chosen_slot_id, conn=None):
     """
     Mark chosen slot=1 for the given session_id and slot_id.
+    Pass conn to run inside the caller's transaction.
     """
     if session_id is None:
         return
@@ -214,19 +361,51 @@ def update_chosen_slot(session_id, chosen_slot_id):
       SET chosen = 1
       WHERE session_id = :sid AND slot_id = :slot
     """)
+    params = {"sid": session_id, "slot": chosen_slot_id}
+    if conn is not None:
+        conn.execute(sql, params)
+        return
     with engine.begin() as conn:
-        conn.execute(sql, {"sid": session_id, "slot": chosen_slot_id})
+        conn.execute(sql, params)
 
-def get_training_data(limit=5000):
+def get_training_cutoff(settle_hours=TRAINING_SETTLE_HOURS):
     """
-    Pull recent recommendation_logs used for training.
+    Newest created_at that is safe to train on: rows must be older than the settle
+    window so late `chosen` updates and slow-committing inserts are already in place.
+    """
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT NOW()::timestamp - make_interval(hours => :h)"),
+                            {"h": settle_hours}).scalar()
+
+def get_training_data(until, limit=5000, chunksize=2000):
+    """
+    Pull recent recommendation_logs used for training (created at or before `until`).
+    Rows are streamed through a server-side cursor in chunks of `chunksize`.
     Returns a pandas DataFrame with training columns plus 'chosen'.
     """
     sql = text("""
-      SELECT same_hour, same_dow, hour_diff, slot_is_free, recent_count, chosen
+      SELECT same_hour, same_dow, hour_diff, slot_is_free, days_since_last, recent_count, chosen
       FROM recommendation_logs
+      WHERE created_at <= :until
       ORDER BY created_at DESC
       LIMIT :limit
     """)
-    return pd.read_sql(sql, engine, params={"limit": limit})
+    chunks = list(pd.read_sql(sql, engine.execution_options(stream_results=True),
+                              params={"until": until, "limit": limit}, chunksize=chunksize))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
 
+def get_training_data_since(since, until, chunksize=2000):
+    """
+    Stream recommendation_logs rows with since < created_at <= until (oldest first).
+    Returns an iterator of DataFrame chunks for incremental training.
+    """
+    sql = text("""
+      SELECT same_hour, same_dow, hour_diff, slot_is_free, days_since_last, recent_count, chosen
+      FROM recommendation_logs
+      WHERE created_at > :since AND created_at <= :until
+      ORDER BY created_at
+    """)
+    return pd.read_sql(sql, engine.execution_options(stream_results=True),
+                       params={"since": since, "until": until}, chunksize=chunksize)
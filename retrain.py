@@ -1,9 +1,43 @@
-from recommender_service import get_training_data, train_ranking_model
+from recommender_service import get_training_data, get_training_data_since, get_training_cutoff, train_ranking_model, load_model
+from db import engine, claim_job_run
+from config import MODEL_RETRAIN_INTERVAL
+
+def retrain(limit=5000, incremental=True):
+    """
+    Retrain on settled logs only (older than the settle window) and record that cutoff
+    as the model's watermark. With incremental=True and a compatible saved model, only
+    rows between the previous watermark and the new cutoff are learned.
+    Returns the trained model, or None if there was nothing to train on.
+    """
+    cutoff = get_training_cutoff()
+    model = load_model()
+    since = getattr(model, 'trained_through_', None)
+    if incremental and since is not None and getattr(model, 'scaler_', None) is not None:
+        # continue training on rows settled since the last run
+        return train_ranking_model(get_training_data_since(since, cutoff), model=model, trained_through=cutoff)
+    df = get_training_data(limit=limit, until=cutoff)
+    if df is None or df.empty:
+        return None
+    return train_ranking_model(df, trained_through=cutoff)
+
+def retrain_job(limit=5000):
+    """
+    Scheduled retrain. Runs in the scheduler's process pool, so it lives here
+    (importable without starting the API) and drops pooled connections
+    inherited from the parent process before touching the DB.
+    """
+    engine.dispose(close=False)
+    try:
+        # one retrain per interval across all schedulers
+        if not claim_job_run('retrain_job', MODEL_RETRAIN_INTERVAL * 86400):
+            return
+        retrain(limit=limit)
+    except Exception:
+        pass
 
 if __name__ == "__main__":
-    df = get_training_data(limit=10000)
-    if df.empty:
+    model = retrain(limit=10000, incremental=False)
+    if model is None:
         print("No training data yet.")
     else:
-        model = train_ranking_model(df)
         print("Model retrained and saved.")
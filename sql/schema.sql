@@ -22,6 +22,11 @@ CREATE TABLE IF NOT EXISTS bookings (
   created_at TIMESTAMP DEFAULT NOW()
 );
 
+-- Last booking per pair (reminder job / reminder_slots): ORDER BY start_time DESC LIMIT 1
+-- On an existing database run as CREATE INDEX CONCURRENTLY to avoid locking writes.
+CREATE INDEX IF NOT EXISTS idx_bookings_pair_start
+  ON bookings (primary_user_id, secondary_user_id, start_time DESC);
+
 -- Available slots
 CREATE TABLE IF NOT EXISTS avail_slots (
   id SERIAL PRIMARY KEY,
@@ -30,6 +35,10 @@ CREATE TABLE IF NOT EXISTS avail_slots (
   is_booked BOOLEAN DEFAULT FALSE
 );
 
+-- Future free slots per primary user (recommendation candidates)
+CREATE INDEX IF NOT EXISTS idx_avail_slots_free
+  ON avail_slots (primary_user_id, slot_time) WHERE is_booked = false;
+
 -- Recommendation logs (for training)
 -- Using session_id as TEXT to avoid requiring UUID extension
 CREATE TABLE IF NOT EXISTS recommendation_logs (
@@ -43,8 +52,18 @@ CREATE TABLE IF NOT EXISTS recommendation_logs (
   same_dow INT,
   hour_diff FLOAT,
   slot_is_free INT,
+  days_since_last INT,
   recent_count INT,
   chosen INT DEFAULT 0,
   created_at TIMESTAMP DEFAULT NOW()
 );
+-- added after the first release: upgrade existing databases in place
+ALTER TABLE recommendation_logs ADD COLUMN IF NOT EXISTS days_since_last INT;
+
+-- Background job runs: one row per job, claimed atomically each interval so only
+-- one scheduler (of possibly several API workers) executes a given tick
+CREATE TABLE IF NOT EXISTS job_runs (
+  name TEXT PRIMARY KEY,
+  last_run TIMESTAMP NOT NULL
+);
 